@@ -6,20 +6,19 @@ import os
 import sys
 import time
 import struct
-import random
 import math
 from copy import deepcopy
 import queue
 from threading import Thread
 from collections import deque
 import io
+import pickle
 import zmq
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 import torch.optim as optim
 from gym.spaces import prng
 from gym.spaces.discrete import Discrete
@@ -32,32 +31,80 @@ from sc2learner.utils.utils import tprint
 
 class DQNAgent(object):
 
-  def __init__(self, network, action_space, init_model_path=None):
+  def __init__(self, network, action_space, init_model_path=None,
+               half_inference=False):
     assert type(action_space) == spaces.Discrete
     self._action_space = action_space
-    self._network = network
+    self._network = torch.jit.script(network)
     if init_model_path is not None:
       self.load_params(torch.load(init_model_path,
                                   map_location=lambda storage, loc: storage))
-    if torch.cuda.device_count() > 1:
-      self._network = nn.DataParallel(self._network)
     if torch.cuda.is_available(): self._network.cuda()
+    torch.backends.cudnn.benchmark = True
     self._optimizer = None
+    self._grad_scaler = None
     self._target_network = None
     self._num_optim_steps = 0
+    self._use_cuda_graph = torch.cuda.is_available()
+    self._cuda_graph = None
+    self._half_inference = half_inference and self._use_cuda_graph
+    if self._half_inference: self._network.half()
+    self._rng = np.random.default_rng()
+    self._uniform_pool = self._rng.random(1024)
+    self._uniform_index = 0
 
   def act(self, observation, eps=0):
     self._network.eval()
-    if random.uniform(0, 1) >= eps:
-      observation = torch.from_numpy(np.expand_dims(observation, 0))
-      if torch.cuda.is_available():
-        observation = observation.pin_memory().cuda(non_blocking=True)
-      with torch.no_grad():
-        q = self._network(observation)
-        action = q.data.max(1)[1].item()
-      return action
+    if self._uniform() >= eps:
+      with torch.inference_mode():
+        if self._use_cuda_graph:
+          q = self._graphed_forward(observation)
+        else:
+          q = self._network(torch.from_numpy(np.expand_dims(observation, 0)))
+        return q.argmax(1).item()
     else:
-      return self._action_space.sample()
+      return int(self._rng.integers(self._action_space.n))
+
+  def act_batch(self, observations):
+    self._network.eval()
+    with torch.inference_mode():
+      observations = torch.from_numpy(observations)
+      if torch.cuda.is_available():
+        observations = observations.pin_memory().cuda(non_blocking=True)
+      if self._half_inference: observations = observations.half()
+      return self._network(observations).argmax(1).cpu().numpy()
+
+  def _uniform(self):
+    if self._uniform_index == len(self._uniform_pool):
+      self._uniform_pool = self._rng.random(len(self._uniform_pool))
+      self._uniform_index = 0
+    self._uniform_index += 1
+    return self._uniform_pool[self._uniform_index - 1]
+
+  def _graphed_forward(self, observation):
+    if (self._cuda_graph is None or
+        self._static_obs.shape[1:] != observation.shape):
+      self._capture_cuda_graph(observation)
+    np.copyto(self._pinned_obs_array, observation)
+    self._static_obs.copy_(self._pinned_obs, non_blocking=True)
+    self._cuda_graph.replay()
+    return self._static_q
+
+  def _capture_cuda_graph(self, observation):
+    self._static_obs = torch.from_numpy(np.expand_dims(observation, 0)).cuda()
+    if self._half_inference: self._static_obs = self._static_obs.half()
+    self._pinned_obs = torch.empty(self._static_obs.shape,
+                                   dtype=self._static_obs.dtype,
+                                   pin_memory=True)
+    self._pinned_obs_array = self._pinned_obs.numpy()[0]
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+      for _ in range(3): self._network(self._static_obs)
+    torch.cuda.current_stream().wait_stream(stream)
+    self._cuda_graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(self._cuda_graph):
+      self._static_q = self._network(self._static_obs)
 
   def optimize_step(self,
                     obs_batch,
@@ -74,52 +121,60 @@ class DQNAgent(object):
                     target_update_interval):
     # create optimizer
     if self._optimizer is None:
+      use_fused = torch.cuda.is_available()
       self._optimizer = optim.Adam(self._network.parameters(),
                                    eps=adam_eps,
-                                   lr=learning_rate)
+                                   lr=learning_rate,
+                                   foreach=not use_fused,
+                                   fused=use_fused)
+      self._grad_scaler = torch.cuda.amp.GradScaler(
+          enabled=torch.cuda.is_available())
     # create target network
     if self._target_network is None:
       self._target_network = deepcopy(self._network)
       if torch.cuda.is_available(): self._target_network.cuda()
       self._target_network.eval()
+      self._online_tensors = list(self._network.parameters()) + \
+          list(self._network.buffers())
+      self._target_tensors = list(self._target_network.parameters()) + \
+          list(self._target_network.buffers())
 
     # update target network
     if self._num_optim_steps % target_update_interval == 0:
-      self._target_network.load_state_dict(self._network.state_dict())
+      with torch.no_grad():
+        torch._foreach_copy_(self._target_tensors, self._online_tensors)
 
-    # move to gpu
-    if torch.cuda.is_available():
-      obs_batch = obs_batch.cuda(non_blocking=True)
-      next_obs_batch = next_obs_batch.cuda(non_blocking=True)
-      action_batch = action_batch.cuda(non_blocking=True)
-      reward_batch = reward_batch.cuda(non_blocking=True)
-      mc_return_batch = mc_return_batch.cuda(non_blocking=True)
-      done_batch = done_batch.cuda(non_blocking=True)
+    # compute q-values of current and next observations in one pass
+    use_amp = torch.cuda.is_available()
+    self._network.train()
+    with torch.autocast('cuda', enabled=use_amp):
+      with torch.no_grad():
+        q_next_target = self._target_network(next_obs_batch.float())
+      q, q_next = torch.split(
+          self._network(torch.cat([obs_batch, next_obs_batch]).float()),
+          obs_batch.size(0))
 
     # compute max-q target
-    self._network.eval()
     with torch.no_grad():
-      q_next_target = self._target_network(next_obs_batch)
-      q_next = self._network(next_obs_batch)
-      futures = q_next_target.gather(
-          1, q_next.max(dim=1)[1].view(-1, 1)).squeeze()
-      futures = futures * (1 - done_batch)
-      target_q = reward_batch + discount * futures
-      target_q = target_q * mmc_beta + (1.0 - mmc_beta) * mc_return_batch
+      target_q = double_q_target(q_next.detach(), q_next_target, reward_batch,
+                                 done_batch, mc_return_batch, discount,
+                                 mmc_beta)
 
     # define loss
-    self._network.train()
-    q = self._network(obs_batch).gather(1, action_batch.view(-1, 1)).squeeze()
-    loss = F.mse_loss(q, target_q.detach())
+    with torch.autocast('cuda', enabled=use_amp):
+      q = q.gather(1, action_batch.view(-1, 1)).squeeze(1)
+      loss = F.mse_loss(q, target_q)
 
     # compute gradient and update parameters
     self._optimizer.zero_grad()
-    loss.backward()
-    for param in self._network.parameters():
-      param.grad.data.clamp_(-gradient_clipping, gradient_clipping)
-    self._optimizer.step()
+    self._grad_scaler.scale(loss).backward()
+    self._grad_scaler.unscale_(self._optimizer)
+    nn.utils.clip_grad_value_(self._network.parameters(), gradient_clipping,
+                              foreach=True)
+    self._grad_scaler.step(self._optimizer)
+    self._grad_scaler.update()
     self._num_optim_steps += 1
-    return loss.data.item()
+    return loss.detach()
 
   def reset(self):
     pass
@@ -128,10 +183,7 @@ class DQNAgent(object):
     self._network.load_state_dict(state_dict)
 
   def read_params(self):
-    if torch.cuda.device_count() > 1:
-      return self._network.module.state_dict()
-    else:
-      return self._network.state_dict()
+    return self._network.state_dict()
 
 
 class DQNActor(object):
@@ -143,7 +195,9 @@ class DQNActor(object):
                network,
                discount,
                send_freq=4.0,
+               replay_observation_dtype=np.float16,
                ports=("5700", "5701", "5702"),
+               inference_port=None,
                learner_ip="localhost"):
     assert type(env.action_space) == spaces.Discrete
     assert len(ports) == 3
@@ -151,20 +205,28 @@ class DQNActor(object):
     self._discount = discount
     self._epsilon = 1.0
 
-    self._agent = DQNAgent(network, env.action_space)
+    self._agent = DQNAgent(network, env.action_space, half_inference=True)
     self._replay_memory = RemoteReplayMemory(
         is_server=False,
         memory_size=memory_size,
         memory_warmup_size=memory_warmup_size,
         send_freq=send_freq,
+        observation_dtype=replay_observation_dtype,
         ports=ports[:2],
         server_ip=learner_ip)
 
     self._zmq_context = zmq.Context()
     self._model_requestor = self._zmq_context.socket(zmq.REQ)
     self._model_requestor.connect("tcp://%s:%s" % (learner_ip, ports[2]))
+    self._inference_requestor = None
+    if inference_port is not None:
+      self._inference_requestor = self._zmq_context.socket(zmq.REQ)
+      self._inference_requestor.connect(
+          "tcp://%s:%s" % (learner_ip, inference_port))
 
   def run(self):
+    self._observations = self._env.reset().copy()
+    self._rollouts = [[] for _ in range(self._env.num_envs)]
     while True:
       # fetch model
       t = time.time()
@@ -176,20 +238,55 @@ class DQNActor(object):
       tprint("Rollout time: %f" % (time.time() - t))
 
   def _rollout(self):
-    rollout, done = [], False
-    observation = self._env.reset()
-    while not done:
-      action = self._agent.act(observation, eps=self._epsilon)
-      next_observation, reward, done, info = self._env.step(action)
-      rollout.append(
-          (observation, action, reward, next_observation, done))
-      observation = next_observation
-
-    discounted_return = 0
+    num_episodes, last_step = 0, None
+    while num_episodes < self._env.num_envs:
+      actions = self._act(self._observations)
+      self._env.send([int(action) for action in actions])
+      # record the previous step while the envs are stepping
+      if last_step is not None: num_episodes += self._record_step(*last_step)
+      next_observations, rewards, dones, infos = self._env.recv()
+      next_observations = next_observations.copy()
+      last_step = (self._observations, actions, rewards, next_observations,
+                   dones, infos)
+      self._observations = next_observations
+    self._record_step(*last_step)
+
+  def _record_step(self, observations, actions, rewards, next_observations,
+                   dones, infos):
+    num_episodes = 0
+    for i, rollout in enumerate(self._rollouts):
+      next_observation = infos[i]['terminal_observation'] if dones[i] \
+          else next_observations[i]
+      rollout.append((observations[i], actions[i], rewards[i],
+                      next_observation, dones[i]))
+      if dones[i]:
+        self._push_episode(rollout)
+        self._rollouts[i] = []
+        num_episodes += 1
+    return num_episodes
+
+  def _push_episode(self, rollout):
+    discounted_return, transitions = 0, []
     for transition in reversed(rollout):
       reward = transition[2]
       discounted_return = discounted_return * self._discount + reward
-      self._replay_memory.push(*transition, discounted_return)
+      transitions.append(Transition(*transition, discounted_return))
+    self._replay_memory.extend(transitions)
+
+  def _act(self, observations):
+    if self._inference_requestor is None and len(observations) == 1:
+      return [self._agent.act(observations[0], eps=self._epsilon)]
+    actions = np.random.randint(self._env.action_space.n,
+                                size=len(observations))
+    explore = np.random.random_sample(len(observations)) < self._epsilon
+    if not explore.all():
+      if self._inference_requestor is None:
+        greedy_actions = self._agent.act_batch(observations)
+      else:
+        self._inference_requestor.send_pyobj(observations)
+        greedy_actions = self._inference_requestor.recv_pyobj()
+      actions = np.where(explore, actions, greedy_actions)
+    return actions
 
   def _update_model(self):
       self._model_requestor.send_string("request model")
@@ -220,9 +317,13 @@ class DQNLearner(object):
                checkpoint_dir,
                checkpoint_interval,
                print_interval,
+               num_batch_threads=2,
                ports=("5700", "5701", "5702"),
+               inference_port=None,
                init_model_path=None):
     assert type(action_space) == spaces.Discrete
+    if inference_port is not None:
+      self._inference_agent = DQNAgent(deepcopy(network), action_space)
     self._agent = DQNAgent(network, action_space)
     self._replay_memory = RemoteReplayMemory(
         is_server=True,
@@ -244,44 +345,60 @@ class DQNLearner(object):
     self._checkpoint_dir = checkpoint_dir
     self._checkpoint_interval = checkpoint_interval
     self._print_interval = print_interval
+    self._num_batch_threads = num_batch_threads
     self._discount = discount
     self._eps_start = eps_start
     self._eps_end = eps_end
     self._eps_decay_steps = eps_decay_steps
     self._eps_decay_steps2 = eps_decay_steps2
     self._epsilon = eps_start
+    self._num_updates = 0
 
     self._zmq_context = zmq.Context()
     self._reply_model_thread = Thread(
         target=self._reply_model, args=(self._zmq_context, ports[2]))
     self._reply_model_thread.start()
+    if inference_port is not None:
+      self._inference_thread = Thread(
+          target=self._serve_inference,
+          args=(self._zmq_context, inference_port))
+      self._inference_thread.start()
 
   def run(self):
-    batch_queue = queue.Queue(8)
-    batch_thread = Thread(target=self._prepare_batch,
-                          args=(batch_queue, self._batch_size,))
-    batch_thread.start()
-
-    updates, loss, total_rollout_frames = 0, [], 0
+    free_slots, batch_queue = queue.Queue(), queue.Queue()
+    for _ in range(self._num_batch_threads + 1):
+      free_slots.put((None, None))
+    batch_threads = [
+        Thread(target=self._prepare_batch,
+               args=(free_slots, batch_queue, self._batch_size,))
+        for _ in range(self._num_batch_threads)
+    ]
+    for thread in batch_threads:
+      thread.start()
+
+    updates, loss_sum, total_rollout_frames = 0, 0.0, 0
     time_start = time.time()
     while True:
       updates += 1
-      observation, next_observation, action, reward, done, mc_return = \
-          batch_queue.get()
+      self._num_updates = updates
+      staging, copied = batch_queue.get()
+      if copied is not None: torch.cuda.current_stream().wait_event(copied)
+      batch = staging.device_tensors
       self._epsilon = self._schedule_epsilon(updates)
-      loss.append(self._agent.optimize_step(
-          obs_batch=observation,
-          next_obs_batch=next_observation,
-          action_batch=action,
-          reward_batch=reward,
-          done_batch=done,
-          mc_return_batch=mc_return,
+      loss_sum += self._agent.optimize_step(
+          obs_batch=batch.observation,
+          next_obs_batch=batch.next_observation,
+          action_batch=batch.action,
+          reward_batch=batch.reward,
+          done_batch=batch.done,
+          mc_return_batch=batch.mc_return,
           discount=self._discount,
           mmc_beta=self._mmc_beta,
           gradient_clipping=self._gradient_clipping,
           adam_eps=self._adam_eps,
           learning_rate=self._learning_rate,
-          target_update_interval=self._target_update_interval))
+          target_update_interval=self._target_update_interval)
+      free_slots.put((staging, self._record_event()))
       self._model_params = self._agent.read_params()
       if updates % self._checkpoint_interval == 0:
         ckpt_path = os.path.join(self._checkpoint_dir,
@@ -292,37 +409,32 @@ class DQNLearner(object):
         train_fps = self._print_interval * self._batch_size / time_elapsed
         rollout_fps = (self._replay_memory.total - total_rollout_frames) \
             / time_elapsed
-        loss_mean = np.mean(loss)
+        loss_mean = float(loss_sum) / self._print_interval
         tprint("Update: %d	Train-fps: %.1f	Rollout-fps: %.1f	"
                "Loss: %.5f	Epsilon: %.5f	Time: %.1f" % (updates, train_fps,
                rollout_fps, loss_mean, self._epsilon, time_elapsed))
-        time_start, loss = time.time(), []
+        time_start, loss_sum = time.time(), 0.0
         total_rollout_frames = self._replay_memory.total
 
-  def _prepare_batch(self, batch_queue, batch_size):
+  def _prepare_batch(self, free_slots, batch_queue, batch_size):
+    copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
     while True:
-      transitions = self._replay_memory.sample(batch_size)
-      batch = self._transitions_to_batch(transitions)
-      batch_queue.put(batch)
-
-  def _transitions_to_batch(self, transitions):
-    batch = Transition(*zip(*transitions))
-    observation = torch.from_numpy(np.stack(batch.observation))
-    next_observation = torch.from_numpy(np.stack(batch.next_observation))
-    reward = torch.FloatTensor(batch.reward)
-    action = torch.LongTensor(batch.action)
-    done = torch.Tensor(batch.done)
-    mc_return = torch.FloatTensor(batch.mc_return)
-
-    if torch.cuda.is_available():
-      observation = observation.pin_memory()
-      next_observation = next_observation.pin_memory()
-      action = action.pin_memory()
-      reward = reward.pin_memory()
-      mc_return = mc_return.pin_memory()
-      done = done.pin_memory()
-
-    return observation, next_observation, action, reward, done, mc_return
+      staging, consumed = free_slots.get()
+      if consumed is not None: consumed.synchronize()
+      if staging is None:
+        batch = self._replay_memory.sample(batch_size)
+        staging = StagingBuffer(batch)
+        for array, field in zip(staging.host_arrays, batch):
+          np.copyto(array, field)
+      else:
+        self._replay_memory.sample(batch_size, out=staging.host_arrays)
+      batch_queue.put((staging, staging.copy_to_device(copy_stream)))
+
+  def _record_event(self):
+    if not torch.cuda.is_available(): return None
+    event = torch.cuda.Event()
+    event.record()
+    return event
 
   def _save_checkpoint(self, checkpoint_path):
     torch.save(self._model_params, checkpoint_path)
@@ -346,3 +458,62 @@ class DQNLearner(object):
       torch.save(self._model_params, f)
       receiver.send_pyobj(f.getvalue(), zmq.SNDMORE)
       receiver.send_pyobj(self._epsilon)
+
+  def _serve_inference(self, zmq_context, port, max_batch_size=256,
+                       max_wait_ms=1):
+    receiver = zmq_context.socket(zmq.ROUTER)
+    receiver.bind("tcp://*:%s" % port)
+    synced_updates = None
+    while True:
+      requests = [receiver.recv_multipart()]
+      while len(requests) < max_batch_size and receiver.poll(max_wait_ms):
+        requests.append(receiver.recv_multipart())
+      if synced_updates != self._num_updates:
+        synced_updates = self._num_updates
+        self._inference_agent.load_params(self._model_params)
+      observations = [pickle.loads(request[-1]) for request in requests]
+      actions = self._inference_agent.act_batch(np.concatenate(observations))
+      splits = np.cumsum([len(obs) for obs in observations])[:-1]
+      for request, action in zip(requests, np.split(actions, splits)):
+        receiver.send_multipart(request[:-1] + [pickle.dumps(action)])
+
+
+@torch.jit.script
+def double_q_target(q_next, q_next_target, reward, done, mc_return,
+                    discount: float, mmc_beta: float):
+  futures = q_next_target.gather(1, q_next.argmax(1, keepdim=True)).squeeze(1)
+  not_done = 1.0 - done.float()
+  target_q = reward + discount * futures.float() * not_done
+  return target_q * mmc_beta + (1.0 - mmc_beta) * mc_return
+
+
+class StagingBuffer(object):
+
+  def __init__(self, batch, alignment=64):
+    offsets, nbytes = [], 0
+    for field in batch:
+      offsets.append(nbytes)
+      nbytes += (field.nbytes + alignment - 1) // alignment * alignment
+    self._host = torch.empty(nbytes, dtype=torch.uint8,
+                             pin_memory=torch.cuda.is_available())
+    if torch.cuda.is_available():
+      self._device = torch.empty(nbytes, dtype=torch.uint8, device='cuda')
+    else:
+      self._device = self._host
+    host_bytes = self._host.numpy()
+    self.host_arrays = Transition(*[
+        host_bytes[offset:offset + field.nbytes].view(field.dtype).reshape(
+            field.shape)
+        for offset, field in zip(offsets, batch)])
+    self.device_tensors = Transition(*[
+        self._device[offset:offset + field.nbytes].view(
+            torch.from_numpy(field[:0]).dtype).view(field.shape)
+        for offset, field in zip(offsets, batch)])
+
+  def copy_to_device(self, stream):
+    if self._device is self._host: return None
+    with torch.cuda.stream(stream):
+      self._device.copy_(self._host, non_blocking=True)
+      event = torch.cuda.Event()
+      event.record(stream)
+    return event
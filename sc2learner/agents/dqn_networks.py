@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from typing import Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -32,10 +34,9 @@ class DuelingQNet(nn.Module):
                            kernel_size=3,
                            stride=2,
                            padding=1)
-    if batchnorm:
-      self.bn1 = nn.BatchNorm2d(32)
-      self.bn2 = nn.BatchNorm2d(32)
-      self.bn3 = nn.BatchNorm2d(16)
+    self.bn1 = nn.BatchNorm2d(32) if batchnorm else nn.Identity()
+    self.bn2 = nn.BatchNorm2d(32) if batchnorm else nn.Identity()
+    self.bn3 = nn.BatchNorm2d(16) if batchnorm else nn.Identity()
 
     self.value_sp_fc = nn.Linear(16 * 8 * 8, 256)
     self.value_nonsp_fc1 = nn.Linear(n_dims, 512)
@@ -48,18 +49,12 @@ class DuelingQNet(nn.Module):
     self.adv_nonsp_fc2 = nn.Linear(512, 512)
     self.adv_nonsp_fc3 = nn.Linear(512, 256)
     self.adv_final_fc = nn.Linear(512, n_out)
-    self._batchnorm = batchnorm
 
-  def forward(self, x):
+  def forward(self, x: Tuple[torch.Tensor, torch.Tensor]):
     spatial, nonspatial = x
-    if self._batchnorm:
-      spatial = F.relu(self.bn1(self.conv1(spatial)))
-      spatial = F.relu(self.bn2(self.conv2(spatial)))
-      spatial = F.relu(self.bn3(self.conv3(spatial)))
-    else:
-      spatial = F.relu(self.conv1(spatial))
-      spatial = F.relu(self.conv2(spatial))
-      spatial = F.relu(self.conv3(spatial))
+    spatial = F.relu(self.bn1(self.conv1(spatial)))
+    spatial = F.relu(self.bn2(self.conv2(spatial)))
+    spatial = F.relu(self.bn3(self.conv3(spatial)))
     spatial = spatial.view(spatial.size(0), -1)
 
     value_sp_state = F.relu(self.value_sp_fc(spatial))
@@ -3,11 +3,11 @@ from __future__ import division
 from __future__ import print_function
 
 from collections import namedtuple
-from collections import deque
 from threading import Thread
-import random
+from threading import Lock
 import time
 
+import numpy as np
 import zmq
 
 
@@ -16,23 +16,87 @@ Transition = namedtuple('Transition',
                          'done', 'mc_return'))
 
 
-class LocalReplayMemory(object):
-  def __init__(self, capacity):
-    self._memory = deque(maxlen=capacity)
-    self._total = 0
+class RingReplayMemory(object):
 
-  def push(self, *args):
-    self._memory.append(Transition(*args))
-    self._total += 1
+  def __init__(self, capacity):
+    self._capacity = capacity
+    self._arrays = None
+    self._reserved, self._size, self._total = 0, 0, 0
+    self._finished = {}
+    self._lock = Lock()
+
+  def extend(self, block):
+    if len(block.action) > self._capacity:
+      block = Transition(*[field[-self._capacity:] for field in block])
+    n = len(block.action)
+    with self._lock:
+      if self._arrays is None:
+        self._arrays = Transition(*[
+            np.empty((self._capacity,) + field.shape[1:], dtype=field.dtype)
+            for field in block])
+      start = self._reserved
+      self._reserved += n
+    cursor = start % self._capacity
+    head = min(n, self._capacity - cursor)
+    for array, field in zip(self._arrays, block):
+      array[cursor:cursor + head] = field[:head]
+      array[:n - head] = field[head:]
+    with self._lock:
+      # only publish rows once every earlier reservation is written as well
+      self._finished[start] = n
+      while self._total in self._finished:
+        self._total += self._finished.pop(self._total)
+      self._size = min(self._total, self._capacity)
+
+  def sample(self, batch_size, out=None):
+    idx = np.random.randint(0, self._size, batch_size)
+    if out is None:
+      return Transition(*[array[idx] for array in self._arrays])
+    for array, buf in zip(self._arrays, out):
+      np.take(array, idx, axis=0, out=buf)
+    return out
 
-  def sample(self, batch_size):
-    return random.sample(self._memory, batch_size)
+  @property
+  def size(self):
+    return self._size
 
   @property
   def total(self):
     return self._total
 
 
+def stack_transitions(transitions, observation_dtype=None):
+  batch = Transition(*zip(*transitions))
+  observation = np.stack(batch.observation)
+  next_observation = np.stack(batch.next_observation)
+  if observation_dtype is not None:
+    observation = observation.astype(observation_dtype, copy=False)
+    next_observation = next_observation.astype(observation_dtype, copy=False)
+  return Transition(observation=observation,
+                    action=np.asarray(batch.action, dtype=np.int64),
+                    reward=np.asarray(batch.reward, dtype=np.float32),
+                    next_observation=next_observation,
+                    done=np.asarray(batch.done, dtype=np.uint8),
+                    mc_return=np.asarray(batch.mc_return, dtype=np.float32))
+
+
+def send_block(socket, block, delta):
+  socket.send_pyobj((delta, [(field.dtype.str, field.shape) for field in block]),
+                    zmq.SNDMORE)
+  for i, field in enumerate(block):
+    socket.send(np.ascontiguousarray(field), copy=False,
+                flags=zmq.SNDMORE if i < len(block) - 1 else 0)
+
+
+def recv_block(socket):
+  delta, specs = socket.recv_pyobj()
+  frames = socket.recv_multipart(copy=False)
+  block = Transition(*[
+      np.frombuffer(frame.buffer, dtype=dtype).reshape(shape)
+      for frame, (dtype, shape) in zip(frames, specs)])
+  return block, delta
+
+
 class RemoteReplayMemory(object):
   def __init__(self,
                is_server,
@@ -42,16 +106,18 @@ class RemoteReplayMemory(object):
                send_freq=1.0,
                num_pull_threads=4,
                ports=("5700", "5701"),
-               server_ip="localhost"):
+               server_ip="localhost",
+               observation_dtype=None):
     assert len(ports) == 2
     assert memory_warmup_size <= memory_size
     self._is_server = is_server
     self._memory_warmup_size = memory_warmup_size
     self._block_size = block_size
+    self._observation_dtype = observation_dtype
 
     if is_server:
       self._num_received, self._num_used, self._total = 0, 0, 0
-      self._cache_blocks = deque(maxlen=memory_size // block_size)
+      self._memory = RingReplayMemory(memory_size)
       self._zmq_context = zmq.Context()
 
       self._receiver_threads = [Thread(target=self._server_proxy_worker,
@@ -61,7 +127,7 @@ class RemoteReplayMemory(object):
                                  for _ in range(num_pull_threads)]
       for thread in self._receiver_threads: thread.start()
     else:
-      self._memory = LocalReplayMemory(memory_size)
+      self._memory = RingReplayMemory(memory_size)
       self._memory_total_last = 0
       self._send_interval = int(block_size / send_freq)
 
@@ -70,24 +136,30 @@ class RemoteReplayMemory(object):
       self._sender.connect("tcp://%s:%s" % (server_ip, ports[0]))
 
   def push(self, *args):
-    assert not self._is_server, "push() cannot be called when is_server=True."
-    self._memory.push(*args)
+    self.extend([Transition(*args)])
+
+  def extend(self, transitions):
+    assert not self._is_server, \
+        "extend() cannot be called when is_server=True."
+    total_last = self._memory.total
+    self._memory.extend(stack_transitions(transitions, self._observation_dtype))
+    num_sends = self._memory.total // self._send_interval - \
+        total_last // self._send_interval
     if (self._memory.total >= self._memory_warmup_size and
-        self._memory.total >= self._block_size and
-        self._memory.total % self._send_interval == 0):
-      block = self._memory.sample(self._block_size)
-      memory_total = self._memory.total
-      memory_delta = memory_total - self._memory_total_last
-      self._memory_total_last = memory_total
-      self._sender.send_pyobj((block, memory_delta))
-
-  def sample(self, batch_size, reuse_ratio=1.0):
+        self._memory.total >= self._block_size):
+      for _ in range(num_sends):
+        block = self._memory.sample(self._block_size)
+        memory_total = self._memory.total
+        memory_delta = memory_total - self._memory_total_last
+        self._memory_total_last = memory_total
+        send_block(self._sender, block, memory_delta)
+
+  def sample(self, batch_size, reuse_ratio=1.0, out=None):
     assert self._is_server, "sample() cannot be called when is_server=False."
     while (self._num_used / reuse_ratio >= self._num_received or
-        self._memory_warmup_size > len(self._cache_blocks) * self._block_size):
+        self._memory_warmup_size > self._memory.size):
       time.sleep(0.001)
-    batch = [random.choice(random.choice(self._cache_blocks))
-             for _ in range(batch_size)]
+    batch = self._memory.sample(batch_size, out=out)
     self._num_used += batch_size
     return batch
 
@@ -102,10 +174,10 @@ class RemoteReplayMemory(object):
     receiver = zmq_context.socket(zmq.PULL)
     receiver.connect("tcp://localhost:%s" % port)
     while True:
-      block, delta = receiver.recv_pyobj()
-      self._cache_blocks.append(block)
+      block, delta = recv_block(receiver)
+      self._memory.extend(block)
       self._total += delta
-      self._num_received += len(block)
+      self._num_received += len(block.action)
 
   def _server_proxy_worker(self, zmq_context, ports):
     assert len(ports) == 2
@@ -118,7 +190,6 @@ class RemoteReplayMemory(object):
 
 if __name__ == '__main__':
   import sys
-  import numpy as np
 
   job_name = sys.argv[1]
   if job_name == 'client':
@@ -99,8 +99,8 @@ def start_lan_agent():
       step_id += 1
     print_action_distribution(env, action_counts)
   except KeyboardInterrupt: pass
-  except: traceback.print_exc()
-  env.close()
+  except Exception: traceback.print_exc()
+  finally: env.close()
 
 
 def main(unused_argv):
@@ -4,6 +4,13 @@ from __future__ import print_function
 
 import sys
 import os
+# OpenMP/BLAS pools size themselves when numpy and torch load, so these
+# defaults must be set before those imports. Actors stay single-threaded; the
+# learner widens torch again below unless the user chose OMP_NUM_THREADS.
+USER_SET_OMP_NUM_THREADS = "OMP_NUM_THREADS" in os.environ
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
 import random
 import time
 
@@ -13,6 +20,9 @@ from absl import flags
 from absl import logging
 
 from sc2learner.envs.raw_env import SC2RawEnv
+from sc2learner.envs.vec_env import DummyVecEnv
+from sc2learner.envs.vec_env import SubprocVecEnv
+from sc2learner.envs.vec_env import ThreadVecEnv
 from sc2learner.envs.actions.zerg_action_wrappers import ZergActionWrapper
 from sc2learner.envs.observations.zerg_observation_wrappers \
     import ZergObservationWrapper
@@ -20,6 +30,7 @@ from sc2learner.agents.dqn_agent import DQNActor
 from sc2learner.agents.dqn_agent import DQNLearner
 from sc2learner.agents.dqn_networks import NonspatialDuelingQNet
 from sc2learner.utils.utils import print_arguments
+from sc2learner.utils.utils import close_on_exit
 
 
 FLAGS = flags.FLAGS
@@ -27,6 +38,9 @@ flags.DEFINE_enum("job_name", 'actor', ['actor', 'learner'], "Job type.")
 flags.DEFINE_string("learner_ip", "localhost", "Learner IP address.")
 flags.DEFINE_string("ports", "5700,5701,5702",
                     "3 ports for distributed replay memory.")
+flags.DEFINE_string("inference_port", None,
+                    "Port for learner-side batched inference. Actors run "
+                    "their own model copy if not set.")
 flags.DEFINE_integer("client_memory_size", 50000,
                      "Total size of client memory.")
 flags.DEFINE_integer("client_memory_warmup_size", 2000,
@@ -35,9 +49,19 @@ flags.DEFINE_integer("server_memory_size", 1000000,
                      "Total size of server memory.")
 flags.DEFINE_integer("server_memory_warmup_size", 100000,
                      "Memory warmup size for client.")
+flags.DEFINE_integer("num_envs", 1, "Number of envs stepped by each actor. "
+                     "Keep it small when many actors share a machine.")
+flags.DEFINE_enum("vec_env", 'dummy', ['dummy', 'thread', 'subproc'],
+                  "How an actor steps its envs: sequentially in-process, in "
+                  "a thread pool, or in subprocesses with shared-memory "
+                  "observations.")
+flags.DEFINE_boolean("pin_env_cpus", False,
+                     "Pin each subprocess env to its own CPU.")
 flags.DEFINE_string("game_version", '4.6', "Game core version.")
 flags.DEFINE_float("discount", 0.995, "Discount factor.")
 flags.DEFINE_float("send_freq", 4.0, "Probability of a step being pushed.")
+flags.DEFINE_enum("replay_obs_dtype", 'float16', ['float16', 'float32'],
+                  "Dtype observations are stored and sent in replay memory.")
 flags.DEFINE_integer("step_mul", 32, "Game steps per agent step.")
 flags.DEFINE_string("difficulties", '1,2,4,6,9,A', "Bot's strengths.")
 flags.DEFINE_float("eps_start", 1.0, "Max greedy epsilon for exploration.")
@@ -48,6 +72,8 @@ flags.DEFINE_float("learning_rate", 1e-6, "Learning rate.")
 flags.DEFINE_float("adam_eps", 1e-7, "Adam optimizer's epsilon.")
 flags.DEFINE_float("gradient_clipping", 10.0, "Gradient clipping threshold.")
 flags.DEFINE_integer("batch_size", 256, "Batch size.")
+flags.DEFINE_integer("num_batch_threads", 2,
+                     "Threads sampling batches from the shared replay memory.")
 flags.DEFINE_float("mmc_beta", 0.9, "Discount.")
 flags.DEFINE_integer("target_update_interval", 10000,
                      "Target net update interval.")
@@ -87,51 +113,71 @@ def create_network(env):
 
 def start_actor_job():
   random.seed(time.time())
-  difficulty = random.choice(FLAGS.difficulties.split(','))
-  game_seed =  random.randint(0, 2**32 - 1)
-  print("Game Seed: %d Difficulty: %s" % (game_seed, difficulty))
-  env = create_env(difficulty, game_seed)
-  network = create_network(env)
-  actor = DQNActor(memory_size=FLAGS.client_memory_size,
-                   memory_warmup_size=FLAGS.client_memory_warmup_size,
-                   env=env,
-                   network=network,
-                   discount=FLAGS.discount,
-                   send_freq=FLAGS.send_freq,
-                   ports=FLAGS.ports.split(','),
-                   learner_ip=FLAGS.learner_ip)
-  actor.run()
-  env.close()
+  env_fns = []
+  for _ in range(FLAGS.num_envs):
+    difficulty = random.choice(FLAGS.difficulties.split(','))
+    game_seed =  random.randint(0, 2**32 - 1)
+    print("Game Seed: %d Difficulty: %s" % (game_seed, difficulty))
+    env_fns.append(lambda d=difficulty, s=game_seed: create_env(d, s))
+  if FLAGS.vec_env == 'dummy': env = DummyVecEnv(env_fns)
+  elif FLAGS.vec_env == 'thread': env = ThreadVecEnv(env_fns)
+  else: env = SubprocVecEnv(env_fns, pin_cpus=FLAGS.pin_env_cpus)
+  close_env = close_on_exit(env)
+  try:
+    network = create_network(env)
+    actor = DQNActor(memory_size=FLAGS.client_memory_size,
+                     memory_warmup_size=FLAGS.client_memory_warmup_size,
+                     env=env,
+                     network=network,
+                     discount=FLAGS.discount,
+                     send_freq=FLAGS.send_freq,
+                     replay_observation_dtype=FLAGS.replay_obs_dtype,
+                     ports=FLAGS.ports.split(','),
+                     inference_port=FLAGS.inference_port,
+                     learner_ip=FLAGS.learner_ip)
+    actor.run()
+  except KeyboardInterrupt: pass
+  finally: close_env()
 
 
 def start_learner_job():
   if not os.path.exists(FLAGS.checkpoint_dir):
     os.makedirs(FLAGS.checkpoint_dir)
+  if not USER_SET_OMP_NUM_THREADS:
+    if hasattr(os, 'sched_getaffinity'):
+      torch.set_num_threads(len(os.sched_getaffinity(0)))
+    else:
+      torch.set_num_threads(os.cpu_count())
 
   env = create_env('1', 0)
-  network = create_network(env)
-  learner = DQNLearner(network=network,
-                       action_space=env.action_space,
-                       memory_size=FLAGS.server_memory_size,
-                       memory_warmup_size=FLAGS.server_memory_warmup_size,
-                       discount=FLAGS.discount,
-                       eps_start=FLAGS.eps_start,
-                       eps_end=FLAGS.eps_end,
-                       eps_decay_steps=FLAGS.eps_decay_steps,
-                       eps_decay_steps2=FLAGS.eps_decay_steps2,
-                       batch_size=FLAGS.batch_size,
-                       mmc_beta=FLAGS.mmc_beta,
-                       gradient_clipping=FLAGS.gradient_clipping,
-                       adam_eps=FLAGS.adam_eps,
-                       learning_rate=FLAGS.learning_rate,
-                       target_update_interval=FLAGS.target_update_interval,
-                       checkpoint_dir=FLAGS.checkpoint_dir,
-                       checkpoint_interval=FLAGS.checkpoint_interval,
-                       print_interval=FLAGS.print_interval,
-                       ports=FLAGS.ports.split(','),
-                       init_model_path=FLAGS.init_model_path)
-  learner.run()
-  env.close()
+  close_env = close_on_exit(env)
+  try:
+    network = create_network(env)
+    learner = DQNLearner(network=network,
+                         action_space=env.action_space,
+                         memory_size=FLAGS.server_memory_size,
+                         memory_warmup_size=FLAGS.server_memory_warmup_size,
+                         discount=FLAGS.discount,
+                         eps_start=FLAGS.eps_start,
+                         eps_end=FLAGS.eps_end,
+                         eps_decay_steps=FLAGS.eps_decay_steps,
+                         eps_decay_steps2=FLAGS.eps_decay_steps2,
+                         batch_size=FLAGS.batch_size,
+                         num_batch_threads=FLAGS.num_batch_threads,
+                         mmc_beta=FLAGS.mmc_beta,
+                         gradient_clipping=FLAGS.gradient_clipping,
+                         adam_eps=FLAGS.adam_eps,
+                         learning_rate=FLAGS.learning_rate,
+                         target_update_interval=FLAGS.target_update_interval,
+                         checkpoint_dir=FLAGS.checkpoint_dir,
+                         checkpoint_interval=FLAGS.checkpoint_interval,
+                         print_interval=FLAGS.print_interval,
+                         ports=FLAGS.ports.split(','),
+                         inference_port=FLAGS.inference_port,
+                         init_model_path=FLAGS.init_model_path)
+    learner.run()
+  except KeyboardInterrupt: pass
+  finally: close_env()
 
 
 def main(argv):
@@ -22,6 +22,7 @@ from sc2learner.envs.actions.zerg_action_wrappers import ZergActionWrapper
 from sc2learner.envs.observations.zerg_observation_wrappers \
     import ZergObservationWrapper
 from sc2learner.utils.utils import print_arguments
+from sc2learner.utils.utils import close_on_exit
 
 
 FLAGS = flags.FLAGS
@@ -99,44 +100,50 @@ def start_actor():
   game_seed =  random.randint(0, 2**32 - 1)
   print("Game Seed: %d Difficulty: %s" % (game_seed, difficulty))
   env = create_env(difficulty, game_seed)
-  policy = {'lstm': LstmPolicy,
-            'mlp': MlpPolicy}[FLAGS.policy]
-  actor = PPOActor(env=env,
-                   policy=policy,
-                   unroll_length=FLAGS.unroll_length,
-                   gamma=FLAGS.discount_gamma,
-                   lam=FLAGS.lambda_return,
-                   learner_ip=FLAGS.learner_ip,
-                   port_A=FLAGS.port_A,
-                   port_B=FLAGS.port_B)
-  actor.run()
-  env.close()
+  close_env = close_on_exit(env)
+  try:
+    policy = {'lstm': LstmPolicy,
+              'mlp': MlpPolicy}[FLAGS.policy]
+    actor = PPOActor(env=env,
+                     policy=policy,
+                     unroll_length=FLAGS.unroll_length,
+                     gamma=FLAGS.discount_gamma,
+                     lam=FLAGS.lambda_return,
+                     learner_ip=FLAGS.learner_ip,
+                     port_A=FLAGS.port_A,
+                     port_B=FLAGS.port_B)
+    actor.run()
+  except KeyboardInterrupt: pass
+  finally: close_env()
 
 
 def start_learner():
   tf_config()
   env = create_env('1', 0)
-  policy = {'lstm': LstmPolicy,
-            'mlp': MlpPolicy}[FLAGS.policy]
-  learner = PPOLearner(env=env,
-                       policy=policy,
-                       unroll_length=FLAGS.unroll_length,
-                       lr=FLAGS.learning_rate,
-                       clip_range=FLAGS.clip_range,
-                       batch_size=FLAGS.batch_size,
-                       ent_coef=FLAGS.ent_coef,
-                       vf_coef=FLAGS.vf_coef,
-                       max_grad_norm=0.5,
-                       queue_size=FLAGS.learner_queue_size,
-                       print_interval=FLAGS.print_interval,
-                       save_interval=FLAGS.save_interval,
-                       learn_act_speed_ratio=FLAGS.learn_act_speed_ratio,
-                       save_dir=FLAGS.save_dir,
-                       init_model_path=FLAGS.init_model_path,
-                       port_A=FLAGS.port_A,
-                       port_B=FLAGS.port_B)
-  learner.run()
-  env.close()
+  close_env = close_on_exit(env)
+  try:
+    policy = {'lstm': LstmPolicy,
+              'mlp': MlpPolicy}[FLAGS.policy]
+    learner = PPOLearner(env=env,
+                         policy=policy,
+                         unroll_length=FLAGS.unroll_length,
+                         lr=FLAGS.learning_rate,
+                         clip_range=FLAGS.clip_range,
+                         batch_size=FLAGS.batch_size,
+                         ent_coef=FLAGS.ent_coef,
+                         vf_coef=FLAGS.vf_coef,
+                         max_grad_norm=0.5,
+                         queue_size=FLAGS.learner_queue_size,
+                         print_interval=FLAGS.print_interval,
+                         save_interval=FLAGS.save_interval,
+                         learn_act_speed_ratio=FLAGS.learn_act_speed_ratio,
+                         save_dir=FLAGS.save_dir,
+                         init_model_path=FLAGS.init_model_path,
+                         port_A=FLAGS.port_A,
+                         port_B=FLAGS.port_B)
+    learner.run()
+  except KeyboardInterrupt: pass
+  finally: close_env()
 
 
 def main(argv):
@@ -3,8 +3,11 @@ from __future__ import division
 from __future__ import print_function
 
 import random
+from collections import defaultdict
 
+import numpy as np
 from s2clientprotocol import sc2api_pb2 as sc_pb
+from s2clientprotocol import raw_pb2 as raw_pb
 from pysc2.lib.typeenums import UNIT_TYPEID as UNIT_TYPE
 from pysc2.lib.typeenums import ABILITY_ID as ABILITY
 
@@ -12,154 +15,142 @@ from sc2learner.envs.actions.function import Function
 import sc2learner.envs.common.utils as utils
 
 
+_ABIL_INJECT = ABILITY.EFFECT_INJECTLARVA.value
+_ABIL_GATHER = ABILITY.HARVEST_GATHER_DRONE.value
+_UT_QUEEN = UNIT_TYPE.ZERG_QUEEN.value
+_UT_DRONE = UNIT_TYPE.ZERG_DRONE.value
+_UT_EXTRACTOR = UNIT_TYPE.ZERG_EXTRACTOR.value
+
+
 class ResourceActions(object):
 
-  @property
-  def action_queens_inject_larva(self):
-    return Function(name="queens_inject_larva",
-                    function=self._all_idle_queens_inject_larva,
-                    is_valid=self._is_valid_all_idle_queens_inject_larva)
-
-  @property
-  def action_idle_workers_gather_minerals(self):
-    return Function(name="idle_workers_gather_minerals",
-                    function=self._all_idle_workers_gather_minerals,
-                    is_valid=self._is_valid_all_idle_workers_gather_minerals)
-
-  @property
-  def action_assign_workers_gather_gas(self):
-    return Function(name="assign_workers_gather_gas",
-                    function=self._assign_workers_gather_gas,
-                    is_valid=self._is_valid_assign_workers_gather_gas)
-
-  @property
-  def action_assign_workers_gather_minerals(self):
-    return Function(name="assign_workers_gather_minerals",
-                    function=self._assign_workers_gather_minerals,
-                    is_valid=self._is_valid_assign_workers_gather_minerals)
+  def __init__(self):
+    self.action_queens_inject_larva = Function(
+        name="queens_inject_larva",
+        function=self._all_idle_queens_inject_larva,
+        is_valid=self._is_valid_all_idle_queens_inject_larva)
+    self.action_idle_workers_gather_minerals = Function(
+        name="idle_workers_gather_minerals",
+        function=self._all_idle_workers_gather_minerals,
+        is_valid=self._is_valid_all_idle_workers_gather_minerals)
+    self.action_assign_workers_gather_gas = Function(
+        name="assign_workers_gather_gas",
+        function=self._assign_workers_gather_gas,
+        is_valid=self._is_valid_assign_workers_gather_gas)
+    self.action_assign_workers_gather_minerals = Function(
+        name="assign_workers_gather_minerals",
+        function=self._assign_workers_gather_minerals,
+        is_valid=self._is_valid_assign_workers_gather_minerals)
 
   def _all_idle_queens_inject_larva(self, dc):
-    injectable_queens = [
-        # TODO: -->idle_units_of_type
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_QUEEN.value)
-        if u.float_attr.energy >= 25
-    ]
-    bases = dc.mature_units_of_types([UNIT_TYPE.ZERG_HATCHERY.value,
-                                      UNIT_TYPE.ZERG_LAIR.value,
-                                      UNIT_TYPE.ZERG_HIVE.value])
-    actions = []
-    for queen in injectable_queens:
-      action = sc_pb.Action()
-      action.action_raw.unit_command.unit_tags.append(queen.tag)
-      action.action_raw.unit_command.ability_id = \
-          ABILITY.EFFECT_INJECTLARVA.value
-      base = utils.closest_unit(queen, bases)
-      action.action_raw.unit_command.target_unit_tag = base.tag
-      actions.append(action)
-    return actions
+    injectable_queens = self._injectable_queens(dc)
+    bases = dc.bases_index
+    if len(injectable_queens.tag) == 0 or len(bases) == 0: return []
+    _, base_ids = bases.query(injectable_queens.xy)
+    return _grouped_commands(_ABIL_INJECT, injectable_queens.tag.tolist(),
+                             [bases.units[i].tag for i in base_ids])
 
   def _is_valid_all_idle_queens_inject_larva(self, dc):
-    injectable_queens = [
-        # TODO: -->idle_units_of_type
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_QUEEN.value)
-        if u.float_attr.energy >= 25
-    ]
-    bases = dc.mature_units_of_types([UNIT_TYPE.ZERG_HATCHERY.value,
-                                      UNIT_TYPE.ZERG_LAIR.value,
-                                      UNIT_TYPE.ZERG_HIVE.value])
-    if len(bases) > 0 and len(injectable_queens) > 0: return True
+    if len(dc.bases) > 0 and len(self._injectable_queens(dc).tag) > 0:
+      return True
     else: return False
 
   def _all_idle_workers_gather_minerals(self, dc):
-    idle_workers = dc.idle_units_of_type(UNIT_TYPE.ZERG_DRONE.value)
-    actions = []
-    for worker in idle_workers:
-      mineral = utils.closest_unit(worker, dc.minerals)
-      action = sc_pb.Action()
-      action.action_raw.unit_command.unit_tags.append(worker.tag)
-      action.action_raw.unit_command.ability_id = \
-          ABILITY.HARVEST_GATHER_DRONE.value
-      action.action_raw.unit_command.target_unit_tag = mineral.tag
-      actions.append(action)
-    return actions
+    idle_workers = dc.idle_units_of_type(_UT_DRONE)
+    minerals = dc.minerals_index
+    if len(idle_workers) == 0 or len(minerals) == 0: return []
+    _, mineral_ids = minerals.query(utils.unit_positions(idle_workers))
+    return _grouped_commands(_ABIL_GATHER, [u.tag for u in idle_workers],
+                             [minerals.units[i].tag for i in mineral_ids])
 
   def _is_valid_all_idle_workers_gather_minerals(self, dc):
-    if (len(dc.idle_units_of_type(UNIT_TYPE.ZERG_DRONE.value)) > 0 and
-        len(dc.minerals) > 0):
+    if len(dc.idle_units_of_type(_UT_DRONE)) > 0 and len(dc.minerals) > 0:
       return True
     else:
       return False
 
   def _assign_workers_gather_gas(self, dc):
-    idle_extractors =  [
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_EXTRACTOR.value)
-        if u.int_attr.ideal_harvesters - u.int_attr.assigned_harvesters > 0
-    ]
-    if len(idle_extractors) == 0: return []
-    extractor = random.choice(idle_extractors)
-    num_workers_need = extractor.int_attr.ideal_harvesters - \
-        extractor.int_attr.assigned_harvesters
-    extractor_tags = set(u.tag for u in dc.units_of_type(
-        UNIT_TYPE.ZERG_EXTRACTOR.value))
-    workers = [
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_DRONE.value)
-        if (len(u.orders) == 0 or
-            (u.orders[0].ability_id == ABILITY.HARVEST_GATHER_DRONE.value and
-             u.orders[0].target_tag not in extractor_tags))
-    ]
+    extractors = dc.cols(_UT_EXTRACTOR)
+    needed = extractors.ideal_harvesters - extractors.assigned_harvesters
+    extractor_ids = np.flatnonzero(needed > 0)
+    if len(extractor_ids) == 0: return []
+    workers = self._mineral_workers(dc)
     if len(workers) == 0: return []
-    assigned_workers = utils.closest_units(extractor, workers, num_workers_need)
-    action = sc_pb.Action()
-    action.action_raw.unit_command.unit_tags.extend(
-        [u.tag for u in assigned_workers])
-    action.action_raw.unit_command.ability_id = \
-        ABILITY.HARVEST_GATHER_DRONE.value
-    action.action_raw.unit_command.target_unit_tag = extractor.tag
-    return [action]
+    worker_tags = set(u.tag for u in workers)
+    drones = dc.drones_index
+    remaining = needed[extractor_ids]
+    k = min(len(drones), int(remaining.sum()) + len(drones) - len(workers))
+    dists, drone_ids = drones.query(extractors.xy[extractor_ids], k=k)
+    dists = dists.reshape(len(extractor_ids), -1)
+    drone_ids = drone_ids.reshape(len(extractor_ids), -1)
+    unit_tags, target_tags = [], []
+    for flat_id in np.argsort(dists, axis=None, kind='stable'):
+      row, col = divmod(int(flat_id), k)
+      tag = drones.units[drone_ids[row, col]].tag
+      if remaining[row] > 0 and tag in worker_tags:
+        worker_tags.remove(tag)
+        remaining[row] -= 1
+        unit_tags.append(tag)
+        target_tags.append(int(extractors.tag[extractor_ids[row]]))
+    return _grouped_commands(_ABIL_GATHER, unit_tags, target_tags)
 
   def _is_valid_assign_workers_gather_gas(self, dc):
-    idle_extractors =  [
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_EXTRACTOR.value)
-        if u.int_attr.ideal_harvesters - u.int_attr.assigned_harvesters > 0
-    ]
-    extractor_tags = set(u.tag for u in dc.units_of_type(
-        UNIT_TYPE.ZERG_EXTRACTOR.value))
-    workers = [
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_DRONE.value)
-        if (len(u.orders) == 0 or
-            (u.orders[0].ability_id == ABILITY.HARVEST_GATHER_DRONE.value and
-             u.orders[0].target_tag not in extractor_tags))
-    ]
-    if len(idle_extractors) > 0 and len(workers) > 0: return True
+    extractors = dc.cols(_UT_EXTRACTOR)
+    if ((extractors.ideal_harvesters > extractors.assigned_harvesters).any() and
+        len(self._mineral_workers(dc)) > 0):
+      return True
     else: return False
 
   def _assign_workers_gather_minerals(self, dc):
-    extractor_tags = set(u.tag for u in dc.units_of_type(
-        UNIT_TYPE.ZERG_EXTRACTOR.value))
-    workers = [
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_DRONE.value)
-        if (len(u.orders) == 0 or
-            (u.orders[0].ability_id == ABILITY.HARVEST_GATHER_DRONE.value and
-             u.orders[0].target_tag in extractor_tags))
-    ]
-    actions = []
-    for worker in random.sample(workers, min(3, len(workers))):
-      target_mineral = utils.closest_unit(worker, dc.minerals)
-      action = sc_pb.Action()
-      action.action_raw.unit_command.unit_tags.append(worker.tag)
-      action.action_raw.unit_command.ability_id = \
-          ABILITY.HARVEST_GATHER_DRONE.value
-      action.action_raw.unit_command.target_unit_tag = target_mineral.tag
-      actions.append(action)
-    return actions
+    workers = self._gas_workers(dc)
+    minerals = dc.minerals_index
+    if len(workers) == 0 or len(minerals) == 0: return []
+    workers = random.sample(workers, min(3, len(workers)))
+    _, mineral_ids = minerals.query(utils.unit_positions(workers))
+    return _grouped_commands(_ABIL_GATHER, [u.tag for u in workers],
+                             [minerals.units[i].tag for i in mineral_ids])
 
   def _is_valid_assign_workers_gather_minerals(self, dc):
-    extractor_tags = set(u.tag for u in dc.units_of_type(
-        UNIT_TYPE.ZERG_EXTRACTOR.value))
-    workers = [
-        u for u in dc.units_of_type(UNIT_TYPE.ZERG_DRONE.value)
+    return len(self._gas_workers(dc)) > 0
+
+  def _injectable_queens(self, dc):
+    # TODO: -->idle_units_of_type
+    queens = dc.cols(_UT_QUEEN)
+    return dc.memoize('injectable_queens',
+                      lambda: queens.select(queens.energy >= 25))
+
+  def _extractor_tags(self, dc):
+    return dc.memoize('extractor_tags',
+                      lambda: set(dc.cols(_UT_EXTRACTOR).tag.tolist()))
+
+  def _mineral_workers(self, dc):
+    extractor_tags = self._extractor_tags(dc)
+    return dc.memoize('mineral_workers', lambda: [
+        u for u in dc.units_of_type(_UT_DRONE)
+        if (len(u.orders) == 0 or
+            (u.orders[0].ability_id == _ABIL_GATHER and
+             u.orders[0].target_tag not in extractor_tags))
+    ])
+
+  def _gas_workers(self, dc):
+    extractor_tags = self._extractor_tags(dc)
+    return dc.memoize('gas_workers', lambda: [
+        u for u in dc.units_of_type(_UT_DRONE)
         if (len(u.orders) == 0 or
-            (u.orders[0].ability_id == ABILITY.HARVEST_GATHER_DRONE.value and
+            (u.orders[0].ability_id == _ABIL_GATHER and
              u.orders[0].target_tag in extractor_tags))
-    ]
-    return len(workers) > 0
+    ])
+
+
+def _grouped_commands(ability_id, unit_tags, target_tags):
+  groups = defaultdict(list)
+  for unit_tag, target_tag in zip(unit_tags, target_tags):
+    groups[target_tag].append(unit_tag)
+  return [
+      sc_pb.Action(action_raw=raw_pb.ActionRaw(
+          unit_command=raw_pb.ActionRawUnitCommand(
+              ability_id=ability_id,
+              target_unit_tag=target_tag,
+              unit_tags=tags)))
+      for target_tag, tags in groups.items()
+  ]
@@ -3,15 +3,27 @@ from __future__ import division
 from __future__ import print_function
 
 import itertools
+from collections import namedtuple
 
+import numpy as np
 from pysc2.lib.typeenums import UNIT_TYPEID as UNIT_TYPE
 
 from sc2learner.envs.common.const import ALLY_TYPE
 from sc2learner.envs.common.const import PLAYER_FEATURE
 from sc2learner.envs.common.const import COMBAT_TYPES
+from sc2learner.envs.common.utils_fast import SpatialIndex
 import sc2learner.envs.common.utils as utils
 
 
+class UnitColumns(namedtuple('UnitColumns', ['tag', 'xy', 'energy',
+                                             'ideal_harvesters',
+                                             'assigned_harvesters'])):
+  __slots__ = ()
+
+  def select(self, mask):
+    return UnitColumns(*[column[mask] for column in self])
+
+
 class DataContext(object):
 
   def __init__(self):
@@ -19,10 +31,12 @@ class DataContext(object):
     self._player = None
     self._raw_data = None
     self._existed_tags = set()
+    self._memo = {}
 
   def update(self, observation):
     for u in self._units:
       self._existed_tags.add(u.tag)
+    self._memo = {}
     self._units = observation['units']
     self._player = observation['player']
     self._raw_data = observation['raw_data']
@@ -36,26 +50,32 @@ class DataContext(object):
                            init_base.float_attr.pos_y)
 
   def units_of_alliance(self, ally):
-    return [u for u in self._units if u.int_attr.alliance == ally]
+    return self.memoize(('units_of_alliance', ally), lambda: [
+        u for u in self._units if u.int_attr.alliance == ally])
 
   def units_of_type(self, type_id, ally=ALLY_TYPE.SELF.value):
-    return [u for u in self.units_of_alliance(ally) if u.unit_type == type_id]
+    return self.memoize(('units_of_type', type_id, ally), lambda: [
+        u for u in self.units_of_alliance(ally) if u.unit_type == type_id])
 
   def mature_units_of_type(self, type_id, ally=ALLY_TYPE.SELF.value):
     return [u for u in self.units_of_type(type_id, ally)
             if u.float_attr.build_progress >= 1.0]
 
   def idle_units_of_type(self, type_id, ally=ALLY_TYPE.SELF.value):
-    return [u for u in self.mature_units_of_type(type_id, ally)
-            if len(u.orders) == 0]
+    return self.memoize(('idle_units_of_type', type_id, ally), lambda: [
+        u for u in self.mature_units_of_type(type_id, ally)
+        if len(u.orders) == 0])
 
   def units_of_types(self, type_list, ally=ALLY_TYPE.SELF.value):
-    type_set = set(type_list)
-    return [u for u in self.units_of_alliance(ally) if u.unit_type in type_set]
+    type_set = frozenset(type_list)
+    return self.memoize(('units_of_types', type_set, ally), lambda: [
+        u for u in self.units_of_alliance(ally) if u.unit_type in type_set])
 
   def mature_units_of_types(self, type_list, ally=ALLY_TYPE.SELF.value):
-    return [u for u in self.units_of_types(type_list, ally)
-            if u.float_attr.build_progress >= 1.0]
+    return self.memoize(
+        ('mature_units_of_types', frozenset(type_list), ally),
+        lambda: [u for u in self.units_of_types(type_list, ally)
+                 if u.float_attr.build_progress >= 1.0])
 
   def idle_units_of_types(self, type_list, ally=ALLY_TYPE.SELF.value):
     return [u for u in self.mature_units_of_types(type_list, ally)
@@ -68,6 +88,27 @@ class DataContext(object):
   def is_new_unit(self, unit):
     return unit.tag not in self._existed_tags
 
+  def memoize(self, key, fn):
+    if key not in self._memo:
+      self._memo[key] = fn()
+    return self._memo[key]
+
+  def cols(self, type_id, ally=ALLY_TYPE.SELF.value):
+    return self.memoize(
+        ('cols', type_id, ally),
+        lambda: self._columns(self.units_of_type(type_id, ally)))
+
+  def _columns(self, units):
+    return UnitColumns(
+        tag=np.array([u.tag for u in units], dtype=np.uint64),
+        xy=utils.unit_positions(units),
+        energy=np.array([u.float_attr.energy for u in units],
+                        dtype=np.float32),
+        ideal_harvesters=np.array([u.int_attr.ideal_harvesters for u in units],
+                                  dtype=np.int32),
+        assigned_harvesters=np.array(
+            [u.int_attr.assigned_harvesters for u in units], dtype=np.int32))
+
   @property
   def units(self):
     return self._units
@@ -103,12 +144,30 @@ class DataContext(object):
   def exploitable_gas(self):
     extractors = self.units_of_type(UNIT_TYPE.ZERG_EXTRACTOR.value) + \
         self.units_of_type(UNIT_TYPE.ZERG_EXTRACTOR.value, ALLY_TYPE.ENEMY)
-    bases = self.mature_units_of_types([UNIT_TYPE.ZERG_HATCHERY.value,
-                                        UNIT_TYPE.ZERG_LAIR.value,
-                                        UNIT_TYPE.ZERG_HIVE.value])
+    bases = self.bases
     return [u for u in self.gas if (utils.closest_distance(u, bases) < 10 and
                                     utils.closest_distance(u, extractors) > 3)]
 
+  @property
+  def bases(self):
+    return self.memoize('bases', lambda: self.mature_units_of_types(
+        [UNIT_TYPE.ZERG_HATCHERY.value,
+         UNIT_TYPE.ZERG_LAIR.value,
+         UNIT_TYPE.ZERG_HIVE.value]))
+
+  @property
+  def minerals_index(self):
+    return self.memoize('minerals_index', lambda: SpatialIndex(self.minerals))
+
+  @property
+  def bases_index(self):
+    return self.memoize('bases_index', lambda: SpatialIndex(self.bases))
+
+  @property
+  def drones_index(self):
+    return self.memoize('drones_index', lambda: SpatialIndex(
+        self.units_of_type(UNIT_TYPE.ZERG_DRONE.value)))
+
   @property
   def mineral_count(self):
     return self._player[PLAYER_FEATURE.MINERALS.value]
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
 from pysc2.lib.unit_controls import Unit
 
 
@@ -21,6 +22,11 @@ def distance(a, b):
     return l2_dist(a, b)
 
 
+def unit_positions(units):
+  return np.array([(u.float_attr.pos_x, u.float_attr.pos_y) for u in units],
+                  dtype=np.float32).reshape(-1, 2)
+
+
 def closest_unit(unit, target_units):
   assert len(target_units) > 0
   return min(target_units, key=lambda u: distance(unit, u))
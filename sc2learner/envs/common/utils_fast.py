@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from scipy.spatial import cKDTree
+try:
+  import numba
+except ImportError:
+  numba = None
+
+import sc2learner.envs.common.utils as utils
+
+
+class SpatialIndex(object):
+
+  def __init__(self, units, kdtree_min_size=64):
+    self.units = units
+    self._xy = utils.unit_positions(units)
+    self._tree = None
+    if len(units) >= kdtree_min_size:
+      self._tree = cKDTree(self._xy, balanced_tree=False, compact_nodes=False)
+
+  def __len__(self):
+    return len(self.units)
+
+  def query(self, points_xy, k=1):
+    if self._tree is not None: return self._tree.query(points_xy, k=k)
+    elif k == 1: return closest_indices(points_xy, self._xy)
+    else: return closest_k_indices(points_xy, self._xy, k)
+
+
+def _closest_indices(points_xy, candidates_xy):
+  dists = np.empty(points_xy.shape[0], dtype=np.float64)
+  ids = np.empty(points_xy.shape[0], dtype=np.int64)
+  for p in range(points_xy.shape[0]):
+    best_id, best_d2 = 0, 1e30
+    for i in range(candidates_xy.shape[0]):
+      dx = candidates_xy[i, 0] - points_xy[p, 0]
+      dy = candidates_xy[i, 1] - points_xy[p, 1]
+      d2 = dx * dx + dy * dy
+      if d2 < best_d2:
+        best_id, best_d2 = i, d2
+    dists[p] = np.sqrt(best_d2)
+    ids[p] = best_id
+  return dists, ids
+
+
+def _closest_k_indices(points_xy, candidates_xy, k):
+  dists = np.empty((points_xy.shape[0], k), dtype=np.float64)
+  ids = np.empty((points_xy.shape[0], k), dtype=np.int64)
+  d2 = np.empty(candidates_xy.shape[0], dtype=np.float64)
+  for p in range(points_xy.shape[0]):
+    for i in range(candidates_xy.shape[0]):
+      dx = candidates_xy[i, 0] - points_xy[p, 0]
+      dy = candidates_xy[i, 1] - points_xy[p, 1]
+      d2[i] = dx * dx + dy * dy
+    order = np.argsort(d2, kind='mergesort')[:k]
+    ids[p] = order
+    dists[p] = np.sqrt(d2[order])
+  return dists, ids
+
+
+# fastmath without 'ninf'/'nnan' so comparisons against the sentinel hold
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+if numba is not None:
+  closest_indices = numba.njit(
+      cache=True, fastmath=_FASTMATH, boundscheck=False)(_closest_indices)
+  closest_k_indices = numba.njit(
+      cache=True, fastmath=_FASTMATH, boundscheck=False)(_closest_k_indices)
+else:
+
+  def closest_indices(points_xy, candidates_xy):
+    diff = points_xy[:, None, :] - candidates_xy[None, :, :]
+    d2 = np.einsum('pij,pij->pi', diff, diff)
+    ids = d2.argmin(1)
+    return np.sqrt(d2[np.arange(len(ids)), ids]), ids
+
+  def closest_k_indices(points_xy, candidates_xy, k):
+    diff = points_xy[:, None, :] - candidates_xy[None, :, :]
+    d2 = np.einsum('pij,pij->pi', diff, diff)
+    ids = np.argsort(d2, axis=1, kind='stable')[:, :k]
+    return np.sqrt(np.take_along_axis(d2, ids, axis=1)), ids
@@ -0,0 +1,233 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class DummyVecEnv(object):
+
+  def __init__(self, env_fns):
+    self._envs = [env_fn() for env_fn in env_fns]
+    self.observation_space = self._envs[0].observation_space
+    self.action_space = self._envs[0].action_space
+    self._observations = None
+    self._actions = None
+
+  @property
+  def num_envs(self):
+    return len(self._envs)
+
+  def reset(self):
+    observations = [env.reset() for env in self._envs]
+    if self._observations is None:
+      self._observations = np.zeros((self.num_envs,) + observations[0].shape,
+                                    dtype=observations[0].dtype)
+    for i, observation in enumerate(observations):
+      self._observations[i] = observation
+    return self._observations
+
+  def send(self, actions):
+    assert self._actions is None
+    self._actions = actions
+
+  def recv(self):
+    rewards, dones, infos = [], [], []
+    for i, (env, action) in enumerate(zip(self._envs, self._actions)):
+      observation, reward, done, info = env.step(action)
+      if done:
+        info = dict(info, terminal_observation=observation)
+        observation = env.reset()
+      self._observations[i] = observation
+      rewards.append(reward)
+      dones.append(done)
+      infos.append(info)
+    self._actions = None
+    return (self._observations, np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=np.bool_), infos)
+
+  def step(self, actions):
+    self.send(actions)
+    return self.recv()
+
+  def close(self):
+    for env in self._envs:
+      env.close()
+
+
+class ThreadVecEnv(object):
+
+  def __init__(self, env_fns):
+    self._pool = ThreadPoolExecutor(max_workers=len(env_fns))
+    self._envs = list(self._pool.map(lambda env_fn: env_fn(), env_fns))
+    self.observation_space = self._envs[0].observation_space
+    self.action_space = self._envs[0].action_space
+    self._observations = None
+    self._futures = None
+
+  @property
+  def num_envs(self):
+    return len(self._envs)
+
+  def reset(self):
+    observations = list(self._pool.map(lambda env: env.reset(), self._envs))
+    if self._observations is None:
+      self._observations = np.zeros((self.num_envs,) + observations[0].shape,
+                                    dtype=observations[0].dtype)
+    for i, observation in enumerate(observations):
+      self._observations[i] = observation
+    return self._observations
+
+  def send(self, actions):
+    assert self._futures is None
+    self._futures = [self._pool.submit(self._step_env, i, action)
+                     for i, action in enumerate(actions)]
+
+  def recv(self):
+    rewards, dones, infos = zip(*[future.result() for future in self._futures])
+    self._futures = None
+    return (self._observations, np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=np.bool_), list(infos))
+
+  def step(self, actions):
+    self.send(actions)
+    return self.recv()
+
+  def close(self):
+    if self._futures is not None:
+      for future in self._futures: future.exception()
+    for env in self._envs:
+      env.close()
+    self._pool.shutdown()
+
+  def _step_env(self, i, action):
+    observation, reward, done, info = self._envs[i].step(action)
+    if done:
+      info = dict(info, terminal_observation=observation)
+      observation = self._envs[i].reset()
+    self._observations[i] = observation
+    return reward, done, info
+
+
+class SubprocVecEnv(object):
+
+  def __init__(self, env_fns, pin_cpus=False):
+    ctx = multiprocessing.get_context('fork')
+    self._remotes, work_remotes = zip(*[ctx.Pipe() for _ in env_fns])
+    pin_cpus = pin_cpus and hasattr(os, 'sched_setaffinity')
+    cpus = sorted(os.sched_getaffinity(0)) if pin_cpus else None
+    self._processes = [
+        ctx.Process(target=_subproc_worker,
+                    args=(work_remote, remote, env_fn,
+                          cpus[i % len(cpus)] if pin_cpus else None))
+        for i, (work_remote, remote, env_fn)
+        in enumerate(zip(work_remotes, self._remotes, env_fns))
+    ]
+    for process in self._processes:
+      process.daemon = True
+      process.start()
+    for work_remote in work_remotes:
+      work_remote.close()
+    self.observation_space, self.action_space = self._remotes[0].recv()
+    for remote in self._remotes[1:]:
+      remote.recv()
+
+    shape = (self.num_envs,) + tuple(self.observation_space.shape)
+    dtype = np.dtype(self.observation_space.dtype)
+    self._shm = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(shape)) * dtype.itemsize)
+    self._observations = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+    for i, remote in enumerate(self._remotes):
+      remote.send(('attach', (self._shm.name, shape, dtype.str, i)))
+    self._waiting = False
+    self._closed = False
+
+  @property
+  def num_envs(self):
+    return len(self._remotes)
+
+  def reset(self):
+    for remote in self._remotes:
+      remote.send(('reset', None))
+    for remote in self._remotes:
+      remote.recv()
+    return self._observations
+
+  def send(self, actions):
+    assert not self._waiting
+    for remote, action in zip(self._remotes, actions):
+      remote.send(('step', action))
+    self._waiting = True
+
+  def recv(self):
+    rewards, dones, infos = zip(*[remote.recv() for remote in self._remotes])
+    self._waiting = False
+    return (self._observations, np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=np.bool_), list(infos))
+
+  def step(self, actions):
+    self.send(actions)
+    return self.recv()
+
+  def close(self):
+    if self._closed: return
+    if self._waiting:
+      for remote in self._remotes: remote.recv()
+    for remote in self._remotes:
+      remote.send(('close', None))
+    for process in self._processes:
+      process.join()
+    self._observations = None
+    self._shm.close()
+    self._shm.unlink()
+    self._closed = True
+
+
+def _attach_shared_memory(name):
+  # The parent owns the segment and is the only process that unlinks it;
+  # attaching must not hand it to a worker-side resource tracker as well.
+  if sys.version_info >= (3, 13):
+    return shared_memory.SharedMemory(name=name, track=False)
+  shm = shared_memory.SharedMemory(name=name)
+  resource_tracker.unregister(shm._name, 'shared_memory')
+  return shm
+
+
+def _subproc_worker(remote, parent_remote, env_fn, cpu=None):
+  parent_remote.close()
+  if cpu is not None: os.sched_setaffinity(0, {cpu})
+  env = env_fn()
+  remote.send((env.observation_space, env.action_space))
+  shm, observation = None, None
+  try:
+    while True:
+      cmd, data = remote.recv()
+      if cmd == 'attach':
+        name, shape, dtype, index = data
+        shm = _attach_shared_memory(name)
+        observation = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[index]
+      elif cmd == 'reset':
+        observation[...] = env.reset()
+        remote.send(None)
+      elif cmd == 'step':
+        next_observation, reward, done, info = env.step(data)
+        if done:
+          info = dict(info, terminal_observation=next_observation)
+          next_observation = env.reset()
+        observation[...] = next_observation
+        remote.send((reward, done, info))
+      elif cmd == 'close':
+        break
+  except KeyboardInterrupt:
+    pass
+  finally:
+    observation = None
+    if shm is not None: shm.close()
+    env.close()
@@ -2,6 +2,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import atexit
+import signal
 from absl import flags
 from datetime import datetime
 
@@ -37,6 +40,26 @@ def tprint(x):
   print("[%s] %s" % (str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')), x))
 
 
+def close_on_exit(env):
+  closed = []
+
+  def close():
+    if not closed:
+      closed.append(True)
+      env.close()
+
+  def close_and_terminate(signum, frame):
+    # worker threads are non-daemon and never return, so re-raise the signal
+    # with its default action instead of unwinding through SystemExit
+    close()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+  atexit.register(close)
+  signal.signal(signal.SIGTERM, close_and_terminate)
+  return close
+
+
 def print_actions(env):
   print("----------------------------- Actions -----------------------------")
   for action_id, action_name in enumerate(env.action_names):
@@ -24,9 +24,13 @@ setup(
     ],
     install_requires=[
         'gym==0.10.5',
-        'torch==0.4.0',
+        'torch>=2.1',
         'tensorflow>=1.4.1',
+        'scipy',
         'joblib',
         'pyzmq'
-    ]
+    ],
+    extras_require={
+        'fast': ['numba'],
+    }
 )